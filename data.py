@@ -0,0 +1,63 @@
+import os
+from functools import lru_cache
+
+import pandas as pd
+
+data_fpath = './data/raw/output.csv'
+# prepared data, written on the first start
+cache_fpath = './data/raw/output.parquet'
+# real power, imaginary power, current and voltage
+val_types = ['p','q','i','v']
+
+
+def prep_datetime(df):
+    """
+    convert day and time columns to a single date time column
+    drop the original day and time columns
+    """
+    # day is already parsed to datetimes by read_csv
+    df['datetime'] = df['day'] + pd.to_timedelta(df['time'])
+    df.set_index('datetime', inplace=True)
+    df.drop(columns=['day','time'], inplace=True)
+    return df
+
+
+def load_and_prep_data():
+    """"
+    load data from the parquet cache if it is newer than the csv,
+    otherwise load the csv, create the dateime column and write
+    the cache for the next start
+    """
+    if (os.path.exists(cache_fpath) 
+            and os.path.getmtime(cache_fpath) >= os.path.getmtime(data_fpath)):
+        return pd.read_parquet(cache_fpath, engine='pyarrow')
+
+    # float32 halves memory and the size of the serialized values,
+    # explicit dtypes also skip the type inference while parsing
+    dtypes = {f"l{n}_{t}": 'float32' for t in val_types for n in range(1, 4)}
+    dtypes['time'] = str
+    df = pd.read_csv(data_fpath, dtype=dtypes, parse_dates=['day'])
+    df = prep_datetime(df)
+    # copy keeps each column contiguous
+    df = df.copy()
+    # write to a temporary file and move it into place, so other
+    # workers starting at the same time never read a partial cache
+    tmp_fpath = f"{cache_fpath}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(tmp_fpath, engine='pyarrow', compression='zstd')
+        os.replace(tmp_fpath, cache_fpath)
+    except OSError:
+        # no cache, e.g. a read only data dir, the csv is read next time
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+
+    return df
+
+
+@lru_cache(maxsize=None)
+def get_df():
+    """
+    load_and_prep_data once per process, every module importing
+    this gets the same dataframe
+    """
+    return load_and_prep_data()
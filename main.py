@@ -1,19 +1,41 @@
-import pandas as pd
+import numpy as np
 import datetime as dt
-import os
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
+from plotly.utils import PlotlyJSONEncoder
+import orjson
+import flask
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
+from flask_caching import Cache
+
+from data import get_df
 
 debug = False
+# webgl traces get slow with many gl subplots, fall back to svg above this
+max_gl_subplots = 4
+# more points than this per trace can't be seen on screen anyway
+max_points = 2000
+# threads used to build the traces of a figure
+max_workers = 4
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css','./assets/custom.css' ]
 
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
-server = app.server
+# dash already gzips responses with flask_compress, the config has
+# to be on the flask app before dash calls Compress on it. prefer
+# brotli, the figure json is long runs of numbers and compresses well
+server = flask.Flask(__name__)
+server.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+server.config['COMPRESS_BR_LEVEL'] = 5
+app = dash.Dash(__name__, server=server,
+                external_stylesheets=external_stylesheets,
+                compress=True)
+cache = Cache(server, config={'CACHE_TYPE': 'SimpleCache',
+                              'CACHE_DEFAULT_TIMEOUT': 300})
 
 label_dict = {"p":"real power",
               "q":"imaginary power",
@@ -79,52 +101,102 @@ app.layout = html.Div(
 ])
 
 
-def prep_datetime(df):
+def group_cols_by_type(df):
     """
-    convert day and time columns to a single date time column
-    drop the original day and time columns
+    map each type symbol to the columns ending with it
     """
-    df['time'] = df['time'].apply(pd.Timedelta)
-    df['datetime'] = pd.to_datetime(df['day']) + df['time']
-    df = df.set_index('datetime')
-    df = df.drop(columns=['day','time'])
-    return df
+    return {t: [c for c in df.columns if c.endswith(t)] for t in label_dict}
 
 
-def load_and_prep_data():
-    """"
-    load data from the csv and create the dateime column
-    """
-    fpath = './data/raw/output.csv'
-    df = pd.read_csv(fpath)
-    df = prep_datetime(df)
+def filter_df_cols(df, type_selection=['p','q','i','v']):
 
-    return df
+    selected_cols = [c for t in type_selection for c in COL_GROUPS[t]]
+    
+    return df[selected_cols]
 
-def filter_df_cols(df, type_selection=['p','q','i','v']):
 
-    selected_cols = []
-    for col in df.columns:
-        if col[-1] in type_selection:
-            selected_cols.append(col)
+def find_nonzero_cols(df):
+    """
+    returns: set of the columns with at least one non zero value
+    """
+    return set(df.columns[(df != 0).any(axis=0)])
+
+
+def outlier_bitmaps(df):
+    """
+    flag values that are within 3 times the standard deviation 
+    from the mean of their column, for all columns at once.
+    the flags are packed to 1 bit per row with np.packbits
+    df: pd.DataFrame with numerical dytpes
+    returns: dict of column name to packed flags, 0 for outliers
+    """
+    mu = df.mean(axis=0)
+    std = df.std(axis=0)
+    mask = (df - mu).abs() <= (3*std)
     
-    return df.loc[:,selected_cols]
+    return {c: np.packbits(mask[c].to_numpy()) for c in df.columns}
 
 
-def filter_outliers_from_series(ser):
+def downsample_positions(vals, max_points=max_points):
     """
-    remove values that are >= or <=  
-    than 3 times the standard deviation from the mean.
-    ser: pd.Series with numerical dytpe
-    returns: filtered pd.Series
+    pick at most max_points positions from vals by keeping the
+    min and max of equal sized buckets, so peaks stay visible.
+    the first and last samples are always kept.
+    vals: 1d np.array with numerical dytpe
+    returns: sorted np.array of positions into vals
     """
-    mu = ser.mean()
-    std = ser.std()
-    lower_limit = mu - (3*std)
-    upper_limit = mu + (3*std)
-    fltr = (ser >= lower_limit) & (ser <= upper_limit)
+    n = len(vals)
+    if n <= max_points:
+        return np.arange(n)
+
+    # round the bucket size up so every sample falls in a bucket,
+    # the short last bucket is padded with the last value
+    n_buckets = (max_points - 2) // 2
+    bucket_size = -(-n // n_buckets)
+    n_buckets = -(-n // bucket_size)
+    n_pad = n_buckets*bucket_size - n
+    padded = np.concatenate([vals, np.repeat(vals[-1:], n_pad)])
+    buckets = padded.reshape(n_buckets, bucket_size)
+    offsets = np.arange(n_buckets) * bucket_size
+    pos = np.concatenate([[0, n-1], # keep the ends so the x range is unchanged
+                          buckets.argmin(axis=1) + offsets,
+                          buckets.argmax(axis=1) + offsets])
+    # padded positions hold the last value, map them back to it
+    pos = np.minimum(pos, n-1)
     
-    return ser.loc[fltr]
+    return np.unique(pos)
+
+
+# subplot layouts keyed by (type_selection, number of rows)
+FIG_TEMPLATES = {}
+
+
+def axis_suffix(row_num):
+    """
+    subplot axes are named x, x2, x3... from the top row down
+    """
+    return '' if row_num == 1 else row_num
+
+
+def get_layout_template(type_selection, n_rows):
+    """
+    build the subplot layout for the selected types with make_subplots
+    the first time, then reuse it from FIG_TEMPLATES.
+    the layout does not depend on the data, only on the selection
+    returns: layout dict
+    """
+    key = (tuple(type_selection), n_rows)
+    if key not in FIG_TEMPLATES:
+        subplot_titles = [f"{label_dict[sym]} ({sym})" for sym in type_selection]
+        fig = make_subplots(rows=n_rows, cols=1,
+                            shared_xaxes=True,
+                            vertical_spacing=0.02,
+                            subplot_titles=subplot_titles)
+        fig.update_xaxes(type='date')
+        fig.update_layout(height=(200*n_rows), width=600)
+        FIG_TEMPLATES[key] = fig.layout.to_plotly_json()
+
+    return FIG_TEMPLATES[key]
 
 
 def make_figure(df, type_selection, filter_outliers=False):
@@ -134,60 +206,96 @@ def make_figure(df, type_selection, filter_outliers=False):
 
     """
     val_cols = df.columns.tolist()
-    label_dict = {"p":"real power",
-                  "q":"imaginary power",
-                  "i":"current",
-                  "v":"voltage"}
     color_dict = {1:'red', 2:'blue', 3:'green'}
-    subplot_titles = [f"{label_dict[sym]} ({sym})" for sym in type_selection]
-
-    fig = make_subplots(rows=len(val_cols), cols=1,
-                        shared_xaxes=True,
-                        vertical_spacing=0.02,
-                        subplot_titles=subplot_titles)
-
-    legend_lst = [] #used to turn on and off add legend booleaN 
 
-    for i, col in enumerate(val_cols):
-
-        y=df[col]
+    # the figure has a subplot row per column
+    trace_type = 'scattergl' if len(val_cols) <= max_gl_subplots else 'scatter'
+
+    # to prevent legend names being added more than once,
+    # only the first column of each phase shows its legend
+    legend_lst = [] 
+    legend_cols = set()
+    for col in val_cols:
+        if col[1] not in legend_lst:
+            legend_lst.append(col[1])
+            legend_cols.add(col)
+
+    def build_trace(col):
+        vals = df[col].to_numpy()
+        pos = np.arange(len(vals))
         if filter_outliers:
-            y = filter_outliers_from_series(y)
+            keep = np.unpackbits(OUTLIER_BITMAPS[col], count=len(vals))
+            pos = np.flatnonzero(keep)
+        pos = pos[downsample_positions(vals[pos])]
+        # x from the precomputed ms since epoch, plotly.js reads numbers
+        # on a date axis much faster than datetime strings
+        x = X_MS[pos]
+        y = vals[pos]
 
         phase_num = int(col[1])
         val_type = col[-1]
-        #is_non_zero used to start plot with zero series disabled 
-        is_non_zero = (y.min() and y.max()) != 0
-        visible_setting = True if is_non_zero else 'legendonly'
+        # start plot with zero series disabled 
+        visible_setting = True if col in NONZERO_COLS else 'legendonly'
         # to ensure subplots are ordered as they are selected
         row_num = type_selection.index(val_type) +1
-        color = color_dict[phase_num]
+        axis_num = axis_suffix(row_num)
         legendgroup_name=f"phase {phase_num}"
-        
-        # to prevent legend names being added more than once
-        if legendgroup_name not in legend_lst:
-            legend_lst.append(legendgroup_name)
-            showlegend = True
-        else:
-            showlegend = False
 
         props_dict={'color':color_dict[phase_num]}
-        fig.add_trace(go.Scatter(x=y.index, y=y,
-                                 legendgroup=legendgroup_name,
-                                 name=legendgroup_name,
-                                 showlegend=showlegend,
-                                 visible=visible_setting,
-                                 line=props_dict),
-                      row=row_num, 
-                      col=1)
-
-    fig.update_layout(height=(200*(i+1)), width=600)
+        # plain dicts, so the properties aren't validated one by one
+        return {'type': trace_type,
+                'x': x, 'y': y,
+                'mode': 'lines',
+                'legendgroup': legendgroup_name,
+                'name': legendgroup_name,
+                'showlegend': col in legend_cols,
+                'visible': visible_setting,
+                'line': props_dict,
+                'xaxis': f"x{axis_num}",
+                'yaxis': f"y{axis_num}"}
+
+    # the columns are independent and numpy releases the GIL,
+    # map keeps the traces in column order
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        traces = list(executor.map(build_trace, val_cols))
+
+    # build the figure in one go, skipping plotly's validation
+    layout = get_layout_template(type_selection, len(val_cols))
+    fig = go.Figure(data=traces, layout=copy.deepcopy(layout), _validate=False)
     
     return fig
 
 ## Load Data and create app callback
 
-DF = load_and_prep_data()
+DF = get_df()
+OUTLIER_BITMAPS = outlier_bitmaps(DF)
+COL_GROUPS = group_cols_by_type(DF)
+NONZERO_COLS = find_nonzero_cols(DF)
+X_MS = DF.index.asi8 // 10**6
+
+
+@cache.memoize()
+def make_figure_dict(type_selection, filter_outliers):
+    """
+    make the figure for the selection as a plain dict, memoized as
+    there are only a few possible selections.
+    cache hits are returned to dash as is, without parsing.
+    type_selection: tuple, the order sets the order of the subplots
+    """
+    tdf = filter_df_cols(DF, type_selection=type_selection)
+    fig = make_figure(tdf, 
+                      type_selection=type_selection,
+                      filter_outliers=filter_outliers)
+
+    # orjson turns the numpy trace arrays into plain lists in C, so
+    # dash's encoder has no numpy left to handle. anything orjson
+    # can't handle goes through plotly's own encoder
+    fig_json = orjson.dumps(fig.to_plotly_json(),
+                            option=orjson.OPT_SERIALIZE_NUMPY,
+                            default=PlotlyJSONEncoder().default)
+
+    return orjson.loads(fig_json)
+
 
 # Connect the Plotly graphs with Dash Components
 # accepts (list_of_Output_objects,list_of_Input_objects)
@@ -213,12 +321,9 @@ def update_graph(type_selection, outlier_radio):
     
     
     outlier_radio_bool = False if outlier_radio=='include' else True
-    tdf = filter_df_cols(DF, type_selection=type_selection)
+    fig_dict = make_figure_dict(tuple(type_selection), outlier_radio_bool)
     
-    fig = make_figure(tdf, 
-                      type_selection=type_selection,
-                      filter_outliers=outlier_radio_bool)    
-    return fig, # must return a tuple
+    return fig_dict, # must return a tuple
 
 
 